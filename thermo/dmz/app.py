@@ -10,16 +10,25 @@ Backend will return result in next query, with association ID.
 Long-term, make the backend connection into a TCP based queue (connection is awkward bit)
 """
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
+import logging
 import os
 from typing import Dict, Union, Optional
 
-from flask import Flask, request, send_from_directory
-from pydantic import BaseModel
+from flask import Flask, g, has_request_context, request, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+import orjson
+from pydantic import BaseModel, Field, TypeAdapter
 
 JSON = Union[Dict, str, int]
 
+def _now_iso() -> str:
+    """The timestamp of the current request (see _stamp_request), else now."""
+    if has_request_context() and (now := g.get('now_iso')):
+        return now
+    return datetime.now().isoformat()
+
 class ZoneRequest(BaseModel):
     security_token: str
     zone_name: str
@@ -30,14 +39,35 @@ class ZoneReply(BaseModel):
     threading_id: str
     method: str  # enum Timeout | ReadEnv | SendTemp
 
+class SensorRaw(BaseModel):
+    """HTU21D readings as the sensor reports them, 16 bits each. Zones send these (see onboard ?raw=1)"""
+    t_u16: int
+    h_u16: int
+
+    def temp_centigrade(self) -> float:
+        # linear from -46.85C to 128.87 in 65536 steps, same as onboard's anavilib
+        return self.t_u16 * (175.72 / 65536.0) - 46.85
+
+    def humid_percent(self) -> float:
+        # linear from -6% to 119% in 65536 steps
+        return self.h_u16 * (125.0 / 65536.0) - 6.0
+
 class Sensors(BaseModel):
     temp_centigrade: Optional[float] = None
     humid_percent: Optional[float] = None
     created_dt: str = "" 
+    # input only: converted to the fields above, and not stored / echoed back
+    sensor_raw: Optional[SensorRaw] = Field(default=None, exclude=True)
 
     def model_post_init(self, __context) -> None:
         if not self.created_dt:
-            self.created_dt = datetime.now().isoformat()
+            self.created_dt = _now_iso()
+        if raw := self.sensor_raw:
+            if self.temp_centigrade is None:
+                self.temp_centigrade = raw.temp_centigrade()
+            if self.humid_percent is None:
+                self.humid_percent = raw.humid_percent()
+            self.sensor_raw = None
 
 class IRCommand(BaseModel):
     lolidk: str = ""
@@ -46,24 +76,57 @@ class IRCommand(BaseModel):
 
     def model_post_init(self, __context) -> None:
         if not self.created_dt:
-            self.created_dt = datetime.now().isoformat()
+            self.created_dt = _now_iso()
 
     def model_mark_accessed(self) -> None:
-        self.last_access_dt = datetime.now().isoformat()
+        self.last_access_dt = _now_iso()
 
 class ZoneState(BaseModel):
     command: Optional[IRCommand] = None
     sensors: Optional[Sensors] = None
 
+# build the validators once, rather than going through the model constructor per request
+SENSORS_ADAPTER = TypeAdapter(Sensors)
+IRCOMMAND_ADAPTER = TypeAdapter(IRCommand)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize responses (notably /zones) with orjson rather than the stdlib json."""
+    def dumps(self, obj, **kwargs) -> str:
+        # kwargs are stdlib json formatting args (indent / separators); orjson is always compact.
+        # keep sorted keys, like flask's default provider
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__) 
+app.json = OrjsonProvider(app)
+logger = logging.getLogger(__name__)
+# chatty only when running under test; the per-response debug lines are not free.
+# (set here rather than under __main__, since gunicorn imports us)
+logging.basicConfig(level=logging.DEBUG if os.environ.get("ENV") in ['TEST', 'DOCKERTEST']
+                    else logging.WARNING)
+
+@app.before_request
+def _stamp_request():
+    # one timestamp per request, shared by every model created or touched while serving it
+    g.now_iso = datetime.now().isoformat()
 
 def assertAuthAzZone(req):
     # skip auth for now, but let's treat house info as 'sensitive', later. 
     assert req
 
+MAXLEN = 10000
+
+def _history():
+    # eventually, this goes into a DB, and we will use some history subsampling. 
+    # eg: daily at noon for ever, hourly for last year, by minute last month.....
+    # until then, a bounded deque drops the oldest entry in O(1) on append.
+    return deque(maxlen=MAXLEN)
+
 ### BEGIN STATE (make this sqlite)
-commands = defaultdict(list) # {zonename -> [IRCommand]}
-sensors = defaultdict(list) # {zonename -> [ Sensors]}
+commands = defaultdict(_history) # {zonename -> deque[IRCommand]}
+sensors = defaultdict(_history) # {zonename -> deque[Sensors]}
 ### END STATE 
 
 def _lastor(lst, default=None):
@@ -77,22 +140,16 @@ def _zone_response(zonename, update_access) -> JSON:
     sns = _lastor(sensors[zonename])
     if cmd and update_access:
         cmd.model_mark_accessed()
-    ret = ZoneState(command = cmd, sensors= sns).model_dump()
-    print(f"_zone_response({zonename}, {update_access}) -> {ret}")
+    # same shape as ZoneState(command=cmd, sensors=sns).model_dump(), minus the temporary model
+    ret = {"command": cmd.model_dump() if cmd else None,
+           "sensors": sns.model_dump() if sns else None}
+    logger.debug("_zone_response(%s, %s) -> %s", zonename, update_access, ret)
     return ret
 
-MAXLEN = 10000
+def _is_silent(req) -> bool:
+    """Did the poster ask us not to bother with a reply? (?silent=1)"""
+    return req.args.get("silent") == "1"
 
-def _append_and_trim(lst, item):
-    """Append an item to the lst, and trim it to max length."""
-    # eventually, this goes into a DB, and we will use some history subsampling. 
-    # eg: daily at noon for ever, hourly for last year, by minute last month.....
-    lst.append(item)
-    while len(lst) > MAXLEN:
-        # I don't care if this is possibly slow if there are many to delete.
-        # we call this on every append
-        del lst[0]
-        
 # FIXME: soonish, make separate endpoints for external client vs internal zones/
 # require different auth for each 
 # and restrict who can update what.
@@ -102,10 +159,14 @@ def update_sensors(zonename:str):
     """
     Update a zone with UpdateZone. Read this zone's states. 
     Register the zone if not already there
+
+    With ?silent=1, reply 204 without building (or marking as read) the zone state.
     """
     assertAuthAzZone(request)
-    sns = Sensors(**request.json)
-    _append_and_trim(sensors[zonename], sns) 
+    sns = SENSORS_ADAPTER.validate_python(request.json)
+    sensors[zonename].append(sns)
+    if _is_silent(request):
+        return "", 204
     return _zone_response(zonename, True)
 
 @app.route("/zone/<string:zonename>/command", methods=['POST'])
@@ -113,13 +174,17 @@ def update_command(zonename:str):
     """
     Update a zone with UpdateZone. Read this zone's states. 
     Register the zone if not already there
+
+    With ?silent=1, reply 204 without building (or marking as read) the zone state.
     """
     assertAuthAzZone(request)
     # assumes body exists, even if it is just {}
     js = request.json
-    cmd = IRCommand(**js)
+    cmd = IRCOMMAND_ADAPTER.validate_python(js)
     # eventually, we will store these and subsample them 
-    _append_and_trim(commands[zonename], cmd) 
+    commands[zonename].append(cmd)
+    if _is_silent(request):
+        return "", 204
     return _zone_response(zonename, True)
 
     
@@ -141,20 +206,23 @@ def test_reset():
     assertAuthAzZone(request)
     # assert running in container
     updates = request.json
-    print(f"updates {updates}")
-    if cmds := updates.get('commands'):
+    logger.debug("updates %s", updates)
+    # present-but-empty clears; a missing key leaves that state alone
+    if (cmds := updates.get('commands')) is not None:
         commands.clear()
-        commands.update(cmds)
-        print(f"commands {cmds}")
-    if snrs := updates.get('sensors'):
+        commands.update({k: deque((IRCOMMAND_ADAPTER.validate_python(c) for c in v), maxlen=MAXLEN)
+                         for k, v in cmds.items()})
+        logger.debug("commands %s", cmds)
+    if (snrs := updates.get('sensors')) is not None:
         sensors.clear()
-        sensors.update(snrs)
-        print(f"sensors {snrs}")
-    print(f"Updated to\nsensors {sensors}\ncommands {commands}")
+        sensors.update({k: deque((SENSORS_ADAPTER.validate_python(s) for s in v), maxlen=MAXLEN)
+                        for k, v in snrs.items()})
+        logger.debug("sensors %s", snrs)
+    logger.debug("Updated to\nsensors %s\ncommands %s", sensors, commands)
     return '"ok"'
 
 
 
 if __name__ == "__main__":
-    # LOG starting / port
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    # the flask dev server handles one request at a time; serve with gunicorn, see run.sh
+    print("run me with: gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 app:app")
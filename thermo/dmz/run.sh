@@ -5,4 +5,5 @@ whoami
 
 echo dmz ENV "${ENV:-idk}"
 
-python app.py
+# one worker: the zone histories live in this process. Threads for concurrency.
+exec gunicorn -w 1 -k gthread --threads 8 -b "0.0.0.0:${PORT:-5000}" app:app
@@ -1,5 +1,6 @@
 from unittest import TestCase
 
+import app as dmz
 from app import app
 
 class DMZTest(TestCase):
@@ -71,3 +72,49 @@ class DMZTest(TestCase):
         assert False
         with app.test_client() as c:
             pass
+
+    def test_history_is_bounded(self):
+        hist = dmz._history()
+        for i in range(dmz.MAXLEN + 5):
+            hist.append(i)
+        self.assertEqual(dmz.MAXLEN, len(hist))
+        self.assertEqual(5, hist[0], "expected oldest entries to be dropped")
+        self.assertEqual(dmz.MAXLEN + 4, dmz._lastor(hist))
+
+    def test_command_post_uses_one_timestamp(self):
+        with app.test_client() as c:
+            js = self.post_200(c, '/zone/z9/command', {'lolidk': 'now'})
+            self.assertEqual(js['command']['created_dt'], js['command']['last_access_dt'],
+                             "expected one timestamp per request")
+
+    def test_silent_post_skips_reply(self):
+        with app.test_client() as c:
+            res = c.post('/zone/z8/sensors?silent=1', json={'temp_centigrade': 8.5})
+            self.assertEqual(204, res.status_code)
+            self.assertEqual(b"", res.data)
+            js = self.get_200(c, '/zones')
+            self.assertEqual(8.5, js['z8']['sensors']['temp_centigrade'])
+            js = self.post_200(c, '/zone/z8/sensors?silent=0', {'temp_centigrade': 9.5})
+            self.assertEqual(9.5, js['sensors']['temp_centigrade'])
+
+    def test_sensors_from_raw(self):
+        with app.test_client() as c:
+            js = self.post_200(c, '/zone/z7/sensors', {'sensor_raw': {'t_u16': 31522, 'h_u16': 31522}})
+            self.assertAlmostEqual(37.67, js['sensors']['temp_centigrade'], places=2)
+            self.assertAlmostEqual(54.12, js['sensors']['humid_percent'], places=2)
+            self.assertNotIn('sensor_raw', js['sensors'])
+
+    def test_reset_seeds_readable_state(self):
+        with app.test_client() as c:
+            self.post_200(c, '/test_reset', {
+                'commands': {'z6': [{'lolidk': 'seeded', 'created_dt': '2024-01-01T00:00:00'}]},
+                'sensors': {'z6': [{'temp_centigrade': 6.5}]}})
+            js = self.get_200(c, '/zones')
+            self.assertEqual('seeded', js['z6']['command']['lolidk'])
+            self.assertEqual(6.5, js['z6']['sensors']['temp_centigrade'])
+
+    def test_reset_empty_clears(self):
+        with app.test_client() as c:
+            self.post_200(c, '/zone/z7/sensors', {'temp_centigrade': 7.0})
+            self.post_200(c, '/test_reset', {'commands': {}, 'sensors': {}})
+            self.assertEqual({}, self.get_200(c, '/zones'))
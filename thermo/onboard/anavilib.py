@@ -8,24 +8,77 @@ This library will require system libraries like i2c to be installed,
 and hopefully described in onboard/README.md
 """
 
-from common import is_test_env
-
-
-def get_smbus():
-    if is_test_env():
-        import smbus_fake  
-        return smbus_fake.SMBus(1)
+import threading
+import time
+
+from common import is_test_env, log, LOG_INFO, LOG_WARN
+
+
+I2C_CLOCK_FREQ = "/sys/class/i2c-adapter/i2c-1/of_node/clock-frequency"
+I2C_FAST_MODE_HZ = 400000
+
+def check_i2c_speed():
+    """
+    Log the bus clock, and warn if it is below fast-mode. The pi defaults to 100kHz; the clock can
+    only be raised in /boot/config.txt (see thermo/README.md), not from here.
+    """
+    try:
+        with open(I2C_CLOCK_FREQ, "rb") as f:
+            # device-tree property: one big-endian u32
+            hz = int.from_bytes(f.read(4), "big")
+    except OSError as e:
+        log(LOG_INFO, "i2c clock unknown", error=str(e))
+        return None
+    log(LOG_INFO, "i2c clock", hz=hz)
+    if hz < I2C_FAST_MODE_HZ:
+        log(LOG_WARN, "i2c below fast-mode; set dtparam=i2c_arm_baudrate=400000", hz=hz)
+    return hz
+
+# decided once, at import, rather than per construction
+if is_test_env():
+    from smbus_fake import SMBus as _SMBUS_CLS
+else:
     # where does this come from? presumably python-rpi.gpio. Also this is not I2C, but seems to work
     # actually, looks like python3-smbus according to web pages
-    import smbus  
-    # Rev 2 of Raspberry Pi and all newer use bus 1
-    return smbus.SMBus(1)
+    from smbus import SMBus as _SMBUS_CLS
+    check_i2c_speed()
 
+# test_app.py swaps smbus_fake in for smbus, so ask the class, not ENV
+FAKE_BUS = _SMBUS_CLS.__module__ == "smbus_fake"
+
+# Rev 2 of Raspberry Pi and all newer use bus 1
+I2C_BUS = 1
 
 ### <<< start theft from anavi-examples.git/sensors/HTU21D/python/htu21d.py
 
-def unit_float(msb, lsb) -> float:
-    return (msb * 256.0 + lsb) / 65536.0
+# raw 16 bit reading -> unit, with the /65536 folded into the scale
+_T_SCALE = 175.72 / 65536.0
+_H_SCALE = 125.0 / 65536.0
+
+def centigrade(t_u16: int) -> float:
+    return t_u16 * _T_SCALE - 46.85
+
+def percent(h_u16: int) -> float:
+    return h_u16 * _H_SCALE - 6.0
+
+# and back again, for faking readings in tests
+def centigrade_u16(temp: float) -> int:
+    return min(max(round((temp + 46.85) / _T_SCALE), 0), 0xFFFF)
+
+def percent_u16(humid: float) -> int:
+    return min(max(round((humid + 6.0) / _H_SCALE), 0), 0xFFFF)
+
+def crc8(data) -> int:
+    """The HTU21D's checksum over the reading's bytes: CRC-8, polynomial x^8 + x^5 + x^4 + 1, init 0"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x131) if crc & 0x80 else (crc << 1)
+    return crc
+
+class CRCError(OSError):
+    """A reading whose checksum doesn't match; treated like any other bus error"""
 
 class HTU21D(object):
     HTU21D_ADDR = 0x40
@@ -34,44 +87,132 @@ class HTU21D(object):
     CMD_RESET = 0xFE
 
     instance = None
+    _instance_lock = threading.Lock()
 
     @classmethod
     def singleton(cls) -> "HTU21D":
-        if x := cls.instance:
+        # fast path is one attribute read; the lock only matters for the first (racing) callers,
+        # so that two threads don't both open the bus.
+        if (x := cls.instance) is not None:
             return x
-        x = cls()
-        cls.instance = x
-        return x
+        with cls._instance_lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
 
     def __init__(self):
-       self.bus = get_smbus()
+       self.bus = _SMBUS_CLS(I2C_BUS)
+       # once up front; after that only when a read fails
+       self.reset()
+
+    # datasheet: a soft reset takes up to 15ms, and the sensor NAKs until it is done
+    RESET_SECS = 0.015
 
     def reset(self):
         self.bus.write_byte(self.HTU21D_ADDR, self.CMD_RESET)
+        time.sleep(self.RESET_SECS)
+
+    def _read_checked(self, cmd):
+        msb, lsb, crc = self.bus.read_i2c_block_data(self.HTU21D_ADDR, cmd, 3)
+        if crc8((msb, lsb)) != crc:
+            raise CRCError(f"HTU21D crc mismatch: {msb:#04x} {lsb:#04x} crc {crc:#04x}")
+        return msb, lsb, crc
+
+    def _read_raw(self, cmd):
+        """
+        One block read of (msb, lsb, crc), checksum verified. Reset the sensor and retry once if the
+        bus errors or the checksum is off.
+        """
+        try:
+            return self._read_checked(cmd)
+        except OSError:
+            self.reset()
+            return self._read_checked(cmd)
            
+    def temperature_raw(self) -> int:
+        """The 16 bit reading, as the sensor reports it"""
+        msb, lsb, crc = self._read_raw(self.CMD_READ_TEMP)
+        return (msb << 8) | lsb
+
     def temperature(self):
         """We model temperature sensor as linear output from -46.85C to 128.87 in 65536 steps"""
-        self.reset()
-        msb, lsb, crc = self.bus.read_i2c_block_data(self.HTU21D_ADDR, self.CMD_READ_TEMP, 3)
-        val = -46.85 + 175.72 * unit_float(msb, lsb)
-        return {"centigrade": val}
+        return {"centigrade": centigrade(self.temperature_raw())}
 
     def temperature_centigrade(self):
         # intentionally brittle so that we don't get None if we start returning farenheit
         return self.temperature()['centigrade']
 
+    def humidity_raw(self) -> int:
+        """The 16 bit reading, as the sensor reports it"""
+        msb, lsb, crc = self._read_raw(self.CMD_READ_HUM)
+        return (msb << 8) | lsb
+
     def humidity(self):
         """We model humidity sensor as having linear output from -6% to 119% in 65536 steps"""
-        self.reset()
-        msb, lsb, crc = self.bus.read_i2c_block_data(self.HTU21D_ADDR, self.CMD_READ_HUM, 3)
-        val = -6 + 125 * unit_float(msb, lsb)
-        return {"percent": val}
+        return {"percent": percent(self.humidity_raw())}
     
     def humidity_percent(self):
         return self.humidity()['percent']
 
+    def read_both_raw(self):
+        """(t_u16, h_u16), read back-to-back."""
+        return self.temperature_raw(), self.humidity_raw()
+
+    def read_both(self):
+        """(centigrade, percent), read back-to-back."""
+        return self.temperature_centigrade(), self.humidity_percent()
+
 ### end theft from anavi-examples.git/sensors/HTU21D/python/htu21d.py >>>
 
+class SensorPoller:
+    """
+    Read the HTU21D on a background thread, so that requests get the latest snapshot without
+    waiting on the bus (or on a stalled sensor).
+    """
+    # a snapshot this many periods old means the poller is stuck (or the sensor keeps failing)
+    STALE_PERIODS = 5
+
+    def __init__(self, period_secs=1.0, max_sleep_secs=60.0):
+        self.period_secs = period_secs
+        self.max_sleep_secs = max_sleep_secs
+        self.stale_secs = self.STALE_PERIODS * period_secs
+        self._lock = threading.RLock()
+        self._snapshot = None  # (monotonic ts, t_u16, h_u16); see centigrade() / percent()
+        self._thread = None
+
+    def read_now(self):
+        """Read the sensor, and update the snapshot."""
+        t_u16, h_u16 = HTU21D.singleton().read_both_raw()
+        snap = (time.monotonic(), t_u16, h_u16)
+        with self._lock:
+            self._snapshot = snap
+        return snap
+
+    def snapshot(self):
+        """The latest (ts, t_u16, h_u16). Reads now if the poller hasn't yet."""
+        with self._lock:
+            snap = self._snapshot
+        return snap or self.read_now()
+
+    def start(self):
+        """Start the background thread, once; later calls are cheap no-ops."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="SensorPoller", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # same backoff as twoway.poll_forever, but capped, and we never give up
+        slp = self.period_secs
+        while True:
+            time.sleep(slp)
+            try:
+                self.read_now()
+                slp = self.period_secs
+            except Exception as e:
+                log(LOG_WARN, "sensor read failed", error=str(e))
+                slp = min(slp * 1.5, self.max_sleep_secs)
+
 class AnaviIRPhat:
     pass
 
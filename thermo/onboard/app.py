@@ -1,41 +1,93 @@
 """
 Main entry point.
 
-Use as an import for testing. Must use the flask cmd line to start  
+Use as an import for testing. Serve it with gunicorn (see run.sh) to start
 """
 
-from anavilib import HTU21D
+from anavilib import FAKE_BUS, HTU21D, SensorPoller, centigrade, centigrade_u16, crc8, percent, percent_u16
 from common import log, LOG_EVERY, LOG_INFO, is_test_env
-from constants import help_msg
+from constants import help_json_bytes
 
 from datetime import datetime
-from collections import defaultdict
-import os
+from collections import OrderedDict, deque
+import itertools
+import threading
+import time
 
 from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize route replies with orjson rather than the stdlib json."""
+    def dumps(self, obj, **kwargs) -> str:
+        # kwargs are stdlib json formatting args (indent / separators); orjson is always compact.
+        # keep sorted keys, like flask's default provider
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__) 
+app.json = OrjsonProvider(app)
 
-c = defaultdict(lambda : 0)
+# hit counts per path. paths are user supplied, so keep only the MAX_PATHS most recently seen.
+MAX_PATHS = 1024
+c = OrderedDict()
 
 @app.route("/<path:path>")
 def root(path):
-    global c
     log(LOG_INFO, "/", path=path)
-    c[path] += 1
-    return f"<P>Hello my name is {path} / {c} </P>"
+    n = c.pop(path, 0) + 1
+    c[path] = n
+    if len(c) > MAX_PATHS:
+        c.popitem(last=False)
+    return f"<P>Hello my name is {path} / {n} </P>"
 
 @app.route("/help")
 @app.route("/about")
 def help():
-    return {"msg": help_msg}
+    return help_json_bytes, 200, {'Content-Type': 'application/json'}
+
+# started on the first /environment request, not at import, so importing app (tests, tools)
+# doesn't spin up a thread on the bus
+poller = SensorPoller()
 
 @app.route("/environment", methods=['GET'])
 def environment():
-    htu = HTU21D.singleton()
-    temp = htu.temperature_centigrade()
-    hum  = htu.humidity_percent()
-    return {"temperature_centigrade" : temp, "humidity_percent": hum}
+    """
+    The latest sensor snapshot, off the I2C bus. ?fresh=1 reads the sensor now.
+
+    ?raw=1 replies with the sensor's 16 bit readings as {"sensor_raw": {"t_u16", "h_u16"}} instead;
+    this is what twoway forwards to the dmz, which does the conversion.
+
+    A snapshot older than poller.stale_secs gets a 503 with its age, rather than a stale reading.
+    """
+    poller.start()
+    ts, t_u16, h_u16 = poller.read_now() if request.args.get("fresh") else poller.snapshot()
+    age = time.monotonic() - ts
+    if age > poller.stale_secs:
+        return {"error": "stale sensor reading", "age_secs": round(age, 1)}, 503
+    if request.args.get("raw"):
+        return {"sensor_raw": {"t_u16": t_u16, "h_u16": h_u16}}
+    return {"temperature_centigrade" : centigrade(t_u16), "humidity_percent": percent(h_u16)}
+
+if FAKE_BUS:
+    # only smbus_fake has readings we can set
+    import smbus_fake
+
+    def _fake_block(u16: int):
+        msb, lsb = u16 >> 8, u16 & 0xFF
+        return msb, lsb, crc8((msb, lsb))
+
+    @app.route("/test_readings", methods=['POST'])
+    def test_readings():
+        """Make the fake sensor read {"temp_centigrade", "humid_percent"} from now on."""
+        js = request.json
+        smbus_fake.blocks[HTU21D.CMD_READ_TEMP] = _fake_block(centigrade_u16(js['temp_centigrade']))
+        smbus_fake.blocks[HTU21D.CMD_READ_HUM] = _fake_block(percent_u16(js['humid_percent']))
+        _, t_u16, h_u16 = poller.read_now()
+        return {"temperature_centigrade" : centigrade(t_u16), "humidity_percent": percent(h_u16)}
 
 cmds = { "2023-01-10T12:34:56.78":
              { "temp": { 'unit': 'centigrade', 'value': 20.5},
@@ -44,10 +96,39 @@ cmds = { "2023-01-10T12:34:56.78":
                # .... many more 
                }}
 
+# PUTs only queue; a timer moves queued commands into cmds in one go, FLUSH_SECS after the first
+FLUSH_SECS = 1.0
+_pending_cmds = deque()  # [(key, command)] not yet in cmds
+_cmds_lock = threading.Lock()
+_flush_timer = None
+# appended to the time in each key, so that two commands in the same tick still get their own key
+_cmd_seq = itertools.count()
+
+def flush_cmds() -> int:
+    """Move pending commands into cmds. Keys are unique, so every queued command lands."""
+    global _flush_timer
+    with _cmds_lock:
+        _flush_timer = None
+        batch = {}
+        while _pending_cmds:
+            k, cmd = _pending_cmds.popleft()
+            batch[k] = cmd
+        cmds.update(batch)
+    return len(batch)
+
+def _schedule_flush():
+    global _flush_timer
+    with _cmds_lock:
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(FLUSH_SECS, flush_cmds)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
 @app.route("/daikin", methods=['GET'])
 def get_daikin():
     """Return a dict of {time : command} sent."""
-    return cmds
+    with _cmds_lock:
+        return dict(cmds)
 
 @app.route("/daikin", methods=['PUT'])
 def set_daikin():
@@ -55,15 +136,20 @@ def set_daikin():
     cmd = js.get('command')
     if not cmd:
         print("Empty command")
-        return
-    k = datetime.now().isoformat()
-    assert k not in cmds, "why are we asserting?"
-    cmds[k] = cmd
+        return {"error": "empty command"}, 400
+    k = f"{datetime.now().isoformat()}#{next(_cmd_seq)}"
+    _pending_cmds.append((k, cmd))
+    _schedule_flush()
+    return {"queued": k}, 202
+
+@app.route("/daikin/flush", methods=['POST'])
+def flush_daikin():
+    """Commit queued commands now, rather than waiting for the timer. For tests."""
+    return {"flushed": flush_cmds()}
 
 
 if __name__ == "__main__":
-    # LOG starting / port
-    # log(LOG_EVERY, "use the `flask --app main run` instead")
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    # the flask dev server handles one request at a time; serve with gunicorn, see run.sh
+    log(LOG_EVERY, "run me with: gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 app:app")
 
 
@@ -3,6 +3,7 @@ Standard functions used everywhere, like:
 """
 from datetime import datetime
 import os
+import time
 
 LOG_EVERY=-10
 LOG_ERROR=-2
@@ -11,13 +12,24 @@ LOG_INFO=0
 LOG_DEBUG=1
 LOG_TRACE=2
 
-LOGLEVEL=LOG_INFO
+# `python -O` (production) drops to warnings and errors only
+LOGLEVEL=LOG_INFO if __debug__ else LOG_WARN
+
+# log timestamps are to the second; only rebuild the string when the second changes
+_last_ts_s = None
+_last_ts_str = ""
+
+def _log_timestamp() -> str:
+    global _last_ts_s, _last_ts_str
+    now_s = int(time.time())
+    if now_s != _last_ts_s:
+        _last_ts_s = now_s
+        _last_ts_str = datetime.fromtimestamp(now_s).isoformat()
+    return _last_ts_str
 
 def log(lvl: int, msg: str, **kwargs):
-    print(f"{lvl} <? {LOGLEVEL}")
-    if LOGLEVEL < lvl : return
-    now = datetime.now().isoformat()
-    print(f"{now} - {msg} {kwargs}")
+    if lvl > LOGLEVEL: return
+    print(f"{_log_timestamp()} - {msg} {kwargs}")
 
 # possibly the least informative name ever
 ENVVAR='ENV'
@@ -25,3 +37,4 @@ ENVVAR='ENV'
 def is_test_env():
     """Are we running in a test environment?"""
     return os.environ.get(ENVVAR) in ['TEST', 'DOCKERTEST']
+
@@ -4,6 +4,8 @@ These are just the constants we use everywhere.
 Tests may import this file to verify expected errors / help is parrotted back
 """
 
+import json
+
 # we should autogen this from __doc__ strings
 help_msg = """
 This message is here because Johan hasn't hooked up a swagger endpoint yet.
@@ -18,5 +20,8 @@ GET
 /history -> history of commands
 """
 
+# the /help reply body, encoded once
+help_json_bytes = json.dumps({"msg": help_msg}).encode('utf-8')
+
  
 
@@ -3,7 +3,13 @@
 echo "starting twoway"
 echo "starting twoway" > twoway.out
 date >> twoway.out
-python twoway.py "http://onboard:5000/environment" "http://dmz:5000/zone/zoneymczoneface/sensors" "http://onboard:5000/daikin" &
+# -O compiles out twoway's per-poll chatter; keep it when testing
+case "${ENV:-}" in
+    TEST|DOCKERTEST) PYFLAGS="" ;;
+    *) PYFLAGS="-O" ;;
+esac
+python $PYFLAGS twoway.py "http://onboard:5000/environment?raw=1" "http://dmz:5000/zone/zoneymczoneface/sensors" "http://onboard:5000/daikin" &
 
 echo "starting app"
-python app.py
+# one worker: the I2C bus, sensor poller and command queue live in this process. Threads for concurrency.
+exec gunicorn -w 1 -k gthread --threads 8 -b "0.0.0.0:${PORT:-5000}" app:app
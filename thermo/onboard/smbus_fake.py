@@ -9,6 +9,9 @@ use like so:
 Nah. we'll use the get-in-there-first low-level import
 """
 
+# cmd -> (msb, lsb, crc) for read_i2c_block_data; tests (and onboard's /test_readings) set these
+blocks = {}
+
 class SMBus:
     def __init__(self, busno):
         pass
@@ -17,4 +20,5 @@ class SMBus:
         pass
 
     def read_i2c_block_data(self, addr, cmd, val) -> tuple[int,int,int]:
-        return 123,34,56
+        # msb, lsb, and the HTU21D's crc8 of the two
+        return blocks.get(cmd, (123,34,197))
@@ -2,45 +2,139 @@ from unittest import TestCase
 
 # This BEFORE other imports on purpose, so that we are the root before
 # others grab pointers to submodules.
+import math
 import sys
+import threading
+import time
 import smbus_fake
 
 sys.modules['smbus'] = smbus_fake
 
+import anavilib
 import app
 import constants
 
+def _flatten(d: dict, prefix=()):
+    """Yield (keypath, leaf) for every leaf of a nested dict."""
+    for k, v in d.items():
+        if isinstance(v, dict) and v:
+            yield from _flatten(v, prefix + (k,))
+        else:
+            yield prefix + (k,), v
+
 def equalish(a,b) -> bool:
     if isinstance(a, dict):
-        return equalish_dict(a, b)
-    if isinstance(a, float):
-        return equalish_float(a, b)
-    return a == b
-
-def equalish_dict(a:dict, b) -> bool:
-    if not isinstance(b, dict):
-        return False
-    if len(a) != len(b):
-        return False
-    for k, va in a.items():
-        vb = b[k]
-        if not equalish(va, vb):
+        if not isinstance(b, dict):
             return False
-    return True
+        fa, fb = dict(_flatten(a)), dict(_flatten(b))
+        return fa.keys() == fb.keys() and all(equalish_leaf(v, fb[k]) for k, v in fa.items())
+    return equalish_leaf(a, b)
 
 epsilon = 0.01
 
-def equalish_float(a:float, b) -> bool:
-    return abs(a - b) < epsilon
+def equalish_leaf(a, b) -> bool:
+    if isinstance(a, float):
+        return math.isclose(a, b, abs_tol=epsilon)
+    return a == b
 
 class AppTest(TestCase):
     # the help message is uniquely stupid to test, but it is a start
     def test_help(self):
-        """Test using local call"""
-        msg = app.help().get('msg')
-        self.assertEqual(constants.help_msg, msg)
+        with app.app.test_client() as c:
+            res = c.get('/help')
+            self.assertEqual(constants.help_msg, res.get_json().get('msg'))
+            self.assertEqual(constants.help_json_bytes, res.get_data())
         
     def test_environment(self):
-        res = app.environment()
         want = {'humidity_percent':  54.12, 'temperature_centigrade': 37.67}
-        self.assertTrue(equalish(want, res))
+        with app.app.test_client() as c:
+            self.assertTrue(equalish(want, c.get('/environment').get_json()))
+            self.assertTrue(equalish(want, c.get('/environment?fresh=1').get_json()))
+            raw = {'sensor_raw': {'t_u16': (123 << 8) | 34, 'h_u16': (123 << 8) | 34}}
+            self.assertEqual(raw, c.get('/environment?raw=1').get_json())
+
+    def test_stale_snapshot_is_503(self):
+        live = app.poller
+        # an hour-long period keeps the background read from refreshing the snapshot under us
+        app.poller = anavilib.SensorPoller(period_secs=3600)
+        try:
+            app.poller._snapshot = (time.monotonic() - app.poller.stale_secs - 1, 0, 0)
+            with app.app.test_client() as c:
+                res = c.get('/environment')
+                self.assertEqual(503, res.status_code)
+                self.assertGreater(res.get_json()['age_secs'], app.poller.stale_secs)
+                self.assertEqual(200, c.get('/environment?fresh=1').status_code)
+        finally:
+            app.poller = live
+
+    def test_fake_readings(self):
+        want = {'humidity_percent': 34.0, 'temperature_centigrade': 12.0}
+        try:
+            with app.app.test_client() as c:
+                res = c.post('/test_readings', json={'temp_centigrade': 12, 'humid_percent': 34})
+                self.assertTrue(equalish(want, res.get_json()))
+                self.assertTrue(equalish(want, c.get('/environment').get_json()))
+        finally:
+            smbus_fake.blocks.clear()
+            app.poller.read_now()
+
+    def test_read_both_does_not_reset(self):
+        htu = anavilib.HTU21D()
+        writes = []
+        htu.bus.write_byte = lambda addr, cmd: writes.append(cmd)
+        temp, hum = htu.read_both()
+        self.assertTrue(equalish(37.67, temp))
+        self.assertTrue(equalish(54.12, hum))
+        self.assertEqual([], writes, "expected no reset on a healthy read")
+
+    def test_singleton_is_shared_across_threads(self):
+        live = anavilib.HTU21D.instance
+        anavilib.HTU21D.instance = None
+        try:
+            got = []
+            threads = [threading.Thread(target=lambda: got.append(anavilib.HTU21D.singleton()))
+                       for _ in range(8)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            self.assertEqual(1, len({id(x) for x in got}))
+        finally:
+            anavilib.HTU21D.instance = live
+
+    def test_daikin_put_is_batched(self):
+        with app.app.test_client() as c:
+            res = c.put('/daikin', json={'command': {'mode': 'HEAT'}})
+            self.assertEqual(202, res.status_code)
+            k = res.get_json()['queued']
+            self.assertEqual(1, c.post('/daikin/flush').get_json()['flushed'])
+            self.assertEqual({'mode': 'HEAT'}, c.get('/daikin').get_json()[k])
+
+    def test_daikin_burst_keeps_every_command(self):
+        with app.app.test_client() as c:
+            keys = [c.put('/daikin', json={'command': {'n': i}}).get_json()['queued']
+                    for i in range(20)]
+            self.assertEqual(20, len(set(keys)), "expected a distinct key per command")
+            self.assertEqual(20, c.post('/daikin/flush').get_json()['flushed'])
+            js = c.get('/daikin').get_json()
+            self.assertEqual([{'n': i} for i in range(20)], [js[k] for k in keys])
+
+    def test_root_counter_is_bounded(self):
+        with app.app.test_client() as c:
+            for i in range(app.MAX_PATHS + 3):
+                c.get(f'/p{i}')
+            self.assertIn(b"/ 2 ", c.get('/p5').data)
+            self.assertEqual(app.MAX_PATHS, len(app.c))
+            self.assertNotIn('p0', app.c)
+
+    def test_crc8(self):
+        # the worked examples from the HTU21D datasheet
+        self.assertEqual(0x7C, anavilib.crc8((0x68, 0x3A)))
+        self.assertEqual(0x6B, anavilib.crc8((0x4E, 0x85)))
+
+    def test_bad_crc_resets_and_raises(self):
+        htu = anavilib.HTU21D()
+        writes = []
+        htu.bus.write_byte = lambda addr, cmd: writes.append(cmd)
+        htu.bus.read_i2c_block_data = lambda addr, cmd, n: (123, 34, 56)
+        with self.assertRaises(anavilib.CRCError):
+            htu.temperature_raw()
+        self.assertEqual([anavilib.HTU21D.CMD_RESET], writes)
@@ -29,18 +29,37 @@ import os
 import sys
 import time
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# one keep-alive session for all three hops, rather than a fresh connection per call.
+# connection errors get a couple of quick retries before the poll counts as failed.
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                       max_retries=Retry(total=2, backoff_factor=0.1))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+TIMEOUT = (1, 5)  # (connect, read) seconds
+_get = _session.get
+_post = _session.post
+_put = _session.put
+
+
+_out_fh = None
 
 def out_file(msg):
-    with open("twoway.out", "a") as f:
-        f.write("twoway: ")
-        f.write(msg)
-        f.write("\n")
-        f.flush()
+    # opened once, on first use, and line buffered: one write per message, no open/close
+    global _out_fh
+    if _out_fh is None:
+        _out_fh = open("twoway.out", "a", buffering=1)
+    _out_fh.write(f"twoway: {msg}\n")
 
 def out_stderr(msg):
     print(msg, file=sys.stderr)
 
-out = out_stderr
+# run.sh starts twoway.out; append to it
+out = out_file
 
 out(f"Nothing to see here, yet... {sys.argv}")
 
@@ -53,18 +72,33 @@ readfrom = sys.argv[1]
 dmz = sys.argv[2]
 writeto = sys.argv[3]
 
+def _ok(r) -> bool:
+    return 200 <= r.status_code < 300
+
+# the dmz keeps replying with the zone's latest command (bumping its last_access_dt each
+# time); only hand each one to onboard once, keyed on when it was created
+_last_forwarded = None
+
+# per-poll chatter is behind `if __debug__:`, which `python -O` compiles away (see run.sh).
+# failures and exits are always reported.
 def poll_once() -> bool:
-    import requests
+    global _last_forwarded
     try:
-        r1 = requests.get(readfrom)
-        out(f"r1 {r1}")
-        if r1.status_code != 200: return False
-        r2 = requests.post(dmz, r1.text)
-        out(f"r2 {r2}")
-        if r2.status_code != 200: return False
-        r3 = requests.post(writeto, r2.text)
-        out(f"r3 {r3}")
-        if r3.status_code != 200: return False
+        r1 = _get(readfrom, timeout=TIMEOUT)
+        if __debug__: out(f"r1 {r1}")
+        if not _ok(r1): return False
+        # pass the json along as json, so the receivers see application/json
+        r2 = _post(dmz, json=r1.json(), timeout=TIMEOUT)
+        if __debug__: out(f"r2 {r2}")
+        if not _ok(r2): return False
+        command = r2.json().get('command')
+        if command is None or command.get('created_dt') == _last_forwarded:
+            return True  # nothing (new) for onboard
+        # onboard's /daikin takes a PUT of {"command": ...}
+        r3 = _put(writeto, json={'command': command}, timeout=TIMEOUT)
+        if __debug__: out(f"r3 {r3}")
+        if not _ok(r3): return False
+        _last_forwarded = command.get('created_dt')
         return True
     except Exception as e:
         out(f"failed to connect: {e}")
@@ -72,23 +106,32 @@ def poll_once() -> bool:
 
 MAXFAIL = 100
 PERIOD_SECS = 5
+MAX_SLEEP_SECS = 300
 
 def poll_forever():
     out("twoway poll forever start")
     attempts = MAXFAIL
     slp = PERIOD_SECS
+    # wake on a fixed cadence of the monotonic clock, rather than sleeping slp after each poll
+    # (which drifts by however long the poll took). If a poll overran, skip the missed ticks.
+    next_tick = time.monotonic()
     while attempts > 0:
-        out(f"sleep: {slp}, attempts left {attempts}")
-        time.sleep(slp) 
-        out(f"poll go, attempts left {attempts}")
+        next_tick += slp
+        now = time.monotonic()
+        if next_tick <= now:
+            # overran: drop the missed ticks, staying on the slp grid
+            next_tick += slp * (int((now - next_tick) // slp) + 1)
+        if __debug__: out(f"sleep: {slp}, attempts left {attempts}")
+        time.sleep(max(0, next_tick - time.monotonic()))
+        if __debug__: out(f"poll go, attempts left {attempts}")
         ok = poll_once()
-        out(f"poll result: {ok}, attempts left {attempts}")
+        if __debug__: out(f"poll result: {ok}, attempts left {attempts}")
         if ok:
             attempts = MAXFAIL
             slp = PERIOD_SECS
         else:
             attempts -= 1
-            slp *= 1.5
+            slp = min(slp * 1.5, MAX_SLEEP_SECS)
     out("too many fail; exit")
 
 out("enter")